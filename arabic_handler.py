@@ -7,19 +7,53 @@ Author: x9ci
 """
 
 import os
-import arabic_reshaper
+import re
+import unicodedata
+from functools import lru_cache
+from arabic_reshaper import ArabicReshaper
 from bidi.algorithm import get_display
 from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.pdfbase.ttfonts import TTFont
 
+# نطاقات الحروف التي تحتاج إلى تشكيل أو اتجاه من اليمين لليسار
+_ARABIC_RE = re.compile(r'[\u0590-\u08FF\uFB50-\uFEFF]')
+
+# يُضبط بعد أول تسجيل ناجح للخط لتجنب فحص سجل الخطوط مجدداً
+_FONT_REGISTERED = False
+
+# مُشكِّل واحد بإعدادات المكتبة الافتراضية يُعاد استخدامه في كل استدعاء
+_RESHAPER = ArabicReshaper()
+
+
+@lru_cache(maxsize=4096)
+def _reshape_cached(text):
+    """تشكيل النص واتجاهه مع التخزين المؤقت للنصوص المتكررة"""
+    return get_display(_RESHAPER.reshape(text))
+
+
+@lru_cache(maxsize=8192)
+def _cached_width(text, font, size):
+    """عرض النص الفعلي من مقاييس الخط مع التخزين المؤقت"""
+    return stringWidth(text, font, size)
+
+
 class ArabicHandler:
     def __init__(self):
         self.font_size = 14
         self.font_name = 'Arabic'
+        # الصعود والنزول بوحدات 1/1000 من حجم الخط، تُقرأ عند تسجيل الخط
+        self._ascent = None
+        self._descent = None
         self.initialize_fonts()
 
     def initialize_fonts(self):
         """تهيئة الخطوط العربية"""
+        global _FONT_REGISTERED
+        if _FONT_REGISTERED:
+            self._load_font_metrics()
+            return True
+
         try:
             font_paths = [
                 "/usr/share/fonts/truetype/arabic/Amiri-Regular.ttf",
@@ -34,6 +68,8 @@ class ArabicHandler:
                         # التحقق مما إذا كان الخط مسجل مسبقاً
                         if self.font_name not in pdfmetrics.getRegisteredFontNames():
                             pdfmetrics.registerFont(TTFont(self.font_name, font_path))
+                        _FONT_REGISTERED = True
+                        self._load_font_metrics()
                         print(f"تم تحميل الخط: {font_path}")
                         return True
                     except Exception as e:
@@ -47,22 +83,35 @@ class ArabicHandler:
             print(f"خطأ في تهيئة الخطوط: {e}")
             return False
 
+    def _load_font_metrics(self):
+        """قراءة مقاييس الخط مرة واحدة"""
+        face = pdfmetrics.getFont(self.font_name).face
+        self._ascent = face.ascent
+        self._descent = face.descent
+
     def process_text(self, text):
         """معالجة النص العربي"""
         try:
-            reshaped_text = arabic_reshaper.reshape(text)
-            bidi_text = get_display(reshaped_text)
-            return bidi_text
+            # النصوص غير العربية لا تحتاج إلى تشكيل أو إعادة ترتيب
+            if not _ARABIC_RE.search(text):
+                return text
+
+            # توحيد الترميز حتى تتطابق النصوص المتماثلة في الذاكرة المؤقتة
+            return _reshape_cached(unicodedata.normalize('NFC', text))
         except Exception as e:
             print(f"خطأ في معالجة النص العربي: {e}")
             return text
 
-    def get_text_dimensions(self, text):
-        """حساب أبعاد النص"""
+    def get_text_dimensions(self, processed_text):
+        """حساب أبعاد نص تمت معالجته مسبقاً عبر process_text"""
         try:
-            processed_text = self.process_text(text)
-            width = len(processed_text) * self.font_size * 0.6
-            height = self.font_size * 1.5
+            if self._ascent is None:
+                # الخط غير مسجل: تقدير تقريبي
+                width = len(processed_text) * self.font_size * 0.6
+                height = self.font_size * 1.5
+            else:
+                width = _cached_width(processed_text, self.font_name, self.font_size)
+                height = (self._ascent - self._descent) * self.font_size / 1000
             return width, height
         except Exception as e:
             print(f"خطأ في حساب أبعاد النص: {e}")
@@ -6,18 +6,45 @@ Created: 2025-01-22 23:10:15
 Author: x9ci
 """
 
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 import logging
-from typing import List, Dict
+import os
+import unicodedata
+from typing import List, Dict, Optional, Tuple
 from reportlab.pdfgen import canvas
 from arabic_handler import ArabicHandler
 
+_EMPTY_BBOX = (0, 0, 0, 0)
+
+_worker_processor = None
+
+
+def _init_worker(text_processor):
+    """تهيئة معالج الصفحات داخل العملية الفرعية"""
+    global _worker_processor
+    # الخط يُورث من العملية الرئيسية أو يُسجل مرة واحدة لكل عملية فرعية
+    _worker_processor = PageProcessor(text_processor)
+
+
+def _process_page_worker(args):
+    """ترجمة صفحة وإنشاء طبقتها داخل عملية فرعية"""
+    blocks, overlay = _worker_processor._process_and_render(*args)
+    return blocks, overlay.getvalue() if overlay is not None else None
+
+
 class PageProcessor:
     def __init__(self, text_processor):
         self.text_processor = text_processor
         self.batch_size = 10
         self.processed_blocks = set()
+        # ترجمات سابقة مفهرسة بالنص الأصلي بعد توحيده
+        self._translation_cache: Dict[str, str] = {}
         self.arabic_handler = ArabicHandler()
+        # فهرس شبكي للمواقع المستخدمة لتسريع فحص التداخل
+        self._pos_grid: Dict[Tuple[int, int], List[tuple]] = {}
+        self._cell_size = self.arabic_handler.font_size * 1.5 * 2
 
     def process_page(self, page_content: List[Dict], page_num: int) -> List[Dict]:
         """معالجة صفحة واحدة"""
@@ -26,19 +53,24 @@ class PageProcessor:
             translated_blocks = []
             text_batch = []
             blocks_to_process = []
+            # إزالة التكرار تقتصر على الصفحة الحالية
+            self.processed_blocks.clear()
 
             if not page_content:
                 logging.warning(f"لا يوجد محتوى في الصفحة {page_num + 1}")
                 return []
 
             # ترتيب المحتوى من أعلى إلى أسفل
-            sorted_content = sorted(
-                page_content,
-                key=lambda x: (-float(x.get('bbox', (0,0,0,0))[1]), float(x.get('bbox', (0,0,0,0))[0]))
-            )
+            # حساب مفاتيح الترتيب مرة واحدة لكل كتلة بدلاً من كل مقارنة
+            keys = [
+                (-float(b['bbox'][1]), float(b['bbox'][0])) if 'bbox' in b else (0.0, 0.0)
+                for b in page_content
+            ]
+            order = sorted(range(len(page_content)), key=keys.__getitem__)
+            sorted_content = [page_content[i] for i in order]
 
             for block in sorted_content:
-                if not self._should_process_block(block):
+                if not self._should_process_block(block, page_num):
                     continue
 
                 text_batch.append(block.get('text', ''))
@@ -59,6 +91,85 @@ class PageProcessor:
             logging.error(f"خطأ في معالجة الصفحة {page_num + 1}: {str(e)}")
             return []
 
+    def process_pages(self, pages: List[List[Dict]], page_sizes: List[tuple],
+                      max_workers: Optional[int] = None) -> List[Tuple[List[Dict], Optional[BytesIO]]]:
+        """ترجمة الصفحات وإنشاء طبقاتها بالتوازي على أنوية المعالج"""
+        if len(pages) != len(page_sizes):
+            raise ValueError("عدد أحجام الصفحات لا يطابق عدد الصفحات")
+
+        args = list(zip(pages, range(len(pages)), page_sizes))
+        max_workers = max_workers or os.cpu_count() or 1
+        if max_workers == 1 or len(pages) <= 1:
+            return [self._process_and_render(*page_args) for page_args in args]
+
+        # الترجمات المخزنة مؤقتاً خاصة بكل عملية فرعية ولا تعود للعملية الرئيسية
+        try:
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_worker,
+                initargs=(self.text_processor,)
+            ) as executor:
+                results = list(executor.map(_process_page_worker, args))
+        except Exception as e:
+            logging.error(f"خطأ في المعالجة المتوازية، الرجوع إلى المعالجة التسلسلية: {str(e)}")
+            return [self._process_and_render(*page_args) for page_args in args]
+
+        return [
+            (blocks, BytesIO(data) if data is not None else None)
+            for blocks, data in results
+        ]
+
+    def _process_and_render(self, page_content: List[Dict], page_num: int,
+                            page_size: tuple) -> Tuple[List[Dict], Optional[BytesIO]]:
+        """ترجمة صفحة وإنشاء طبقة الترجمة الخاصة بها"""
+        blocks = self.process_page(page_content, page_num)
+        if not blocks:
+            return blocks, None
+        return blocks, self.create_translated_overlay(blocks, page_num, page_size)
+
+    async def translate_pages_async(self, pages: List[List[Dict]],
+                                    page_sizes: List[tuple]) -> List[Optional[BytesIO]]:
+        """ترجمة الصفحات وإنشاء طبقاتها مع تداخل انتظار الترجمة وبناء الطبقات"""
+        if len(pages) != len(page_sizes):
+            raise ValueError("عدد أحجام الصفحات لا يطابق عدد الصفحات")
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=2)
+        overlays: List[Optional[BytesIO]] = [None] * len(pages)
+
+        async def produce():
+            # الترجمة في خيط منفصل حتى لا يتوقف بناء طبقة الصفحة السابقة
+            for page_num, page_content in enumerate(pages):
+                blocks = await loop.run_in_executor(
+                    None, self.process_page, page_content, page_num
+                )
+                await queue.put((page_num, blocks))
+            await queue.put(None)
+
+        async def consume():
+            # طبقة واحدة في كل مرة لأن الفهرس الشبكي مشترك بين الصفحات
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                page_num, blocks = item
+                if blocks:
+                    overlays[page_num] = await loop.run_in_executor(
+                        None, self.create_translated_overlay,
+                        blocks, page_num, page_sizes[page_num]
+                    )
+
+        producer = asyncio.ensure_future(produce())
+        consumer = asyncio.ensure_future(consume())
+        try:
+            await asyncio.gather(producer, consumer)
+        finally:
+            # إلغاء الطرف الآخر إذا فشل أحدهما حتى لا يبقى عالقاً على الطابور
+            producer.cancel()
+            consumer.cancel()
+            await asyncio.gather(producer, consumer, return_exceptions=True)
+        return overlays
+
     def create_translated_overlay(self, translated_blocks: List[Dict], page_num: int, page_size: tuple) -> BytesIO:
         """إنشاء طبقة الترجمة"""
         try:
@@ -66,34 +177,28 @@ class PageProcessor:
             width, height = float(page_size[0]), float(page_size[1])
             c = canvas.Canvas(packet, pagesize=page_size)
             used_positions = []
+            self._pos_grid = {}
 
-            for block in translated_blocks:
-                try:
-                    if block['type'] != 'text' or not block.get('text'):
-                        continue
+            valid_blocks = [b for b in translated_blocks if self._valid_translated_block(b)]
 
-                    text = block['text']
-                    # معالجة النص العربي
-                    processed_text = self.arabic_handler.process_text(text)
-                    text_width, text_height = self.arabic_handler.get_text_dimensions(text)
+            for block in valid_blocks:
+                # معالجة النص العربي
+                processed_text = self.arabic_handler.process_text(block['text'])
+                text_width, text_height = self.arabic_handler.get_text_dimensions(processed_text)
 
-                    # حساب الموقع
-                    bbox = block['original_bbox']
-                    x, y = self._find_optimal_position(
-                        bbox, text_width, text_height, used_positions, width, height
-                    )
+                # حساب الموقع
+                bbox = block['original_bbox']
+                x, y = self._find_optimal_position(
+                    bbox, text_width, text_height, width, height
+                )
 
-                    # رسم خلفية وكتابة النص
-                    self._draw_text_block(c, processed_text, x, y, text_width, text_height)
-                    
-                    # رسم خط توضيحي
-                    self._draw_connection_line(c, x, y, bbox, text_width, text_height, height)
-                    
-                    used_positions.append((x, y, text_width, text_height))
+                used_positions.append((processed_text, x, y, text_width, text_height, bbox))
+                self._add_position((x, y, text_width, text_height))
 
-                except Exception as e:
-                    logging.error(f"خطأ في معالجة كتلة نص: {str(e)}")
-                    continue
+            # الرسم على دفعات: الخلفيات ثم النصوص ثم الخطوط التوضيحية
+            self._draw_backgrounds(c, used_positions)
+            self._draw_texts(c, used_positions)
+            self._draw_connection_lines(c, used_positions, height)
 
             c.save()
             packet.seek(0)
@@ -103,32 +208,65 @@ class PageProcessor:
             logging.error(f"خطأ في إنشاء طبقة الترجمة: {str(e)}")
             return self._create_empty_page(width, height)
 
-    def _should_process_block(self, block: Dict) -> bool:
+    def _should_process_block(self, block: Dict, page_num: Optional[int] = None) -> bool:
         """التحقق مما إذا كان يجب معالجة الكتلة"""
         if not block.get('text'):
             return False
         
         # تحويل النص إلى سلسلة نصية وتنظيفه
-        text = str(block.get('text', '')).strip()
+        text = unicodedata.normalize('NFC', str(block.get('text', ''))).strip()
         
         # تجاهل النصوص القصيرة جداً والأرقام
         if len(text) < 3 or text.isdigit():
             return False
-            
+
+        # تجاهل الكتل المكررة في نفس الموقع من نفس الصفحة
+        bbox = block.get('bbox')
+        if bbox is not None:
+            key = (block.get('page', page_num), tuple(bbox), text)
+            if key in self.processed_blocks:
+                return False
+            self.processed_blocks.add(key)
+
         return True
 
+    def _valid_translated_block(self, block: Dict) -> bool:
+        """التحقق من صلاحية الكتلة المترجمة للرسم"""
+        bbox = block.get('original_bbox')
+        return (
+            block.get('type') == 'text'
+            and bool(block.get('text'))
+            and isinstance(bbox, (tuple, list))
+            and len(bbox) == 4
+        )
+
     def _process_batch(self, texts: List[str], blocks: List[Dict], translated_blocks: List[Dict], page_num: int):
         """معالجة دفعة من النصوص"""
         try:
-            translations = self.text_processor.process_text_batch(texts)
-            
+            keys = [unicodedata.normalize('NFC', str(text)).strip() for text in texts]
+
+            # ترجمة النصوص غير المخزنة فقط، مع إزالة التكرار داخل الدفعة
+            pending = {}
+            for key, text in zip(keys, texts):
+                if key not in self._translation_cache and key not in pending:
+                    pending[key] = text
+
+            if pending:
+                results = self.text_processor.process_text_batch(list(pending.values()))
+                for key, trans in zip(pending, results):
+                    if trans and trans.strip():
+                        self._translation_cache[key] = trans
+
+            translations = [self._translation_cache.get(key) for key in keys]
+
             for trans, block in zip(translations, blocks):
                 if trans and trans.strip():
+                    bbox = block['bbox'] if 'bbox' in block else _EMPTY_BBOX
                     translated_block = {
                         'text': trans,
                         'original_text': block.get('text', ''),
-                        'bbox': block.get('bbox', (0,0,0,0)),
-                        'original_bbox': block.get('bbox', (0,0,0,0)),
+                        'bbox': bbox,
+                        'original_bbox': bbox,
                         'type': 'text',
                         'page': page_num
                     }
@@ -137,41 +275,57 @@ class PageProcessor:
         except Exception as e:
             logging.error(f"خطأ في معالجة دفعة الترجمة: {str(e)}")
 
-    def _draw_text_block(self, canvas_obj, text: str, x: float, y: float, width: float, height: float):
-        """رسم كتلة النص مع خلفية"""
-        # رسم خلفية
+    def _draw_backgrounds(self, canvas_obj, placements: List[tuple]):
+        """رسم خلفيات كتل النص دفعة واحدة"""
+        if not placements:
+            return
+
         padding = 4
         canvas_obj.saveState()
         canvas_obj.setFillColorRGB(1, 1, 1, 0.9)  # خلفية بيضاء شبه شفافة
-        canvas_obj.rect(
-            x - padding,
-            y - padding,
-            width + (2 * padding),
-            height + (2 * padding),
-            fill=True
-        )
+        # حدود باهتة بنفس نمط الخطوط التوضيحية
+        canvas_obj.setStrokeColorRGB(0.7, 0.7, 0.7, 0.3)
+        canvas_obj.setLineWidth(0.3)
+        # مسار واحد لكل المستطيلات بدلاً من استدعاء rect لكل كتلة
+        # (B: تعبئة بقاعدة non-zero ورسم الحدود بنمط الخط المضبوط أعلاه)
+        canvas_obj._code.append(" ".join(
+            f"{x - padding:.2f} {y - padding:.2f} "
+            f"{width + 2 * padding:.2f} {height + 2 * padding:.2f} re"
+            for _, x, y, width, height, _ in placements
+        ) + " B")
         canvas_obj.restoreState()
 
-        # كتابة النص
+    def _draw_texts(self, canvas_obj, placements: List[tuple]):
+        """كتابة النصوص المترجمة دفعة واحدة"""
+        if not placements:
+            return
+
         canvas_obj.setFont('Arabic', self.arabic_handler.font_size)
         canvas_obj.setFillColorRGB(0, 0, 0)
-        canvas_obj.drawRightString(x + width, y + height - 2, text)
+        for text, x, y, width, height, _ in placements:
+            canvas_obj.drawRightString(x + width, y + height - 2, text)
+
+    def _draw_connection_lines(self, canvas_obj, placements: List[tuple], page_height: float):
+        """رسم خطوط تربط النصوص المترجمة بالنصوص الأصلية"""
+        if not placements:
+            return
 
-    def _draw_connection_line(self, canvas_obj, x: float, y: float, bbox: tuple, 
-                            text_width: float, text_height: float, page_height: float):
-        """رسم خط يربط النص المترجم بالنص الأصلي"""
         canvas_obj.setStrokeColorRGB(0.7, 0.7, 0.7, 0.3)
         canvas_obj.setLineWidth(0.3)
-        
-        start_x = x + text_width / 2
-        start_y = y + text_height / 2
-        end_x = (bbox[0] + bbox[2]) / 2
-        end_y = page_height - ((bbox[1] + bbox[3]) / 2)
-        
-        canvas_obj.line(start_x, start_y, end_x, end_y)
 
-    def _find_optimal_position(self, bbox: tuple, text_width: float, text_height: float, 
-                             used_positions: List[tuple], page_width: float, page_height: float) -> tuple:
+        # حساب كل الإحداثيات دفعة واحدة ثم رسمها في مسار واحد
+        canvas_obj.lines([
+            (
+                x + text_width * 0.5,
+                y + text_height * 0.5,
+                (bbox[0] + bbox[2]) * 0.5,
+                page_height - (bbox[1] + bbox[3]) * 0.5
+            )
+            for _, x, y, text_width, text_height, bbox in placements
+        ])
+
+    def _find_optimal_position(self, bbox: tuple, text_width: float, text_height: float,
+                             page_width: float, page_height: float) -> tuple:
         """إيجاد أفضل موقع للنص"""
         x = bbox[0]
         y = page_height - bbox[3] - text_height - 5
@@ -179,7 +333,7 @@ class PageProcessor:
         x = max(5, min(x, page_width - text_width - 5))
         y = max(5, min(y, page_height - text_height - 5))
         
-        while self._check_overlap((x, y, text_width, text_height), used_positions):
+        while self._check_overlap((x, y, text_width, text_height)):
             y -= text_height + 5
             if y < 5:
                 y = page_height - text_height - 5
@@ -189,13 +343,35 @@ class PageProcessor:
         
         return x, y
 
-    def _check_overlap(self, current_rect: tuple, used_positions: List[tuple]) -> bool:
+    def _grid_cells(self, rect: tuple):
+        """خلايا الشبكة التي يغطيها المستطيل"""
+        x, y, w, h = rect
+        size = self._cell_size
+        for cx in range(int(x // size), int((x + w) // size) + 1):
+            for cy in range(int(y // size), int((y + h) // size) + 1):
+                yield cx, cy
+
+    def _add_position(self, rect: tuple):
+        """إضافة موقع مستخدم إلى الفهرس الشبكي"""
+        for cell in self._grid_cells(rect):
+            self._pos_grid.setdefault(cell, []).append(rect)
+
+    def _check_overlap(self, current_rect: tuple) -> bool:
         """التحقق من تداخل النصوص"""
         x, y, w, h = current_rect
-        for used_x, used_y, used_w, used_h in used_positions:
-            if (x < used_x + used_w and x + w > used_x and
-                y < used_y + used_h and y + h > used_y):
-                return True
+        right, top = x + w, y + h
+        grid = self._pos_grid
+        size = self._cell_size
+        y_cells = range(int(y // size), int(top // size) + 1)
+        for cx in range(int(x // size), int(right // size) + 1):
+            for cy in y_cells:
+                rects = grid.get((cx, cy))
+                if not rects:
+                    continue
+                for used_x, used_y, used_w, used_h in rects:
+                    if (x < used_x + used_w and right > used_x and
+                        y < used_y + used_h and top > used_y):
+                        return True
         return False
 
     def _create_empty_page(self, width: float, height: float) -> BytesIO: